@@ -1 +1,16 @@
-__all__ = ["gcalendar", "lectio", "lesson", "run"]
+__all__ = [
+    "batch",
+    "cassette",
+    "changelog",
+    "driverpool",
+    "gcalendar",
+    "ics",
+    "journal",
+    "lectio",
+    "lesson",
+    "offline",
+    "run",
+    "sink",
+    "syncwindow",
+    "worker",
+]
@@ -0,0 +1,217 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import concurrent.futures
+import csv
+import sys
+import traceback
+from . import driverpool
+from . import lectio
+from . import run
+from . import syncwindow
+
+
+class InvalidUserLineError(Exception):
+    """A user line must contain school id, user type, user id and calendar."""
+
+
+class User(object):
+    def __init__(self, school_id, user_type, user_id, calendar_name):
+        self.school_id = school_id
+        self.user_type = user_type
+        self.user_id = user_id
+        self.calendar_name = calendar_name
+
+    def __repr__(self):
+        return "school: {}, type: {}, id: {}, calendar: {}".format(
+            self.school_id, self.user_type, self.user_id, self.calendar_name
+        )
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Scrapes the Lectio schedules of several users "
+        "and syncs them to Google Calendar."
+    )
+    parser.add_argument(
+        "users_file",
+        help="CSV file with one user per line: "
+        "school_id,user_type,user_id,calendar",
+    )
+    run.add_sync_arguments(parser)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of users to sync at the same time. (default: 1)",
+    )
+    parser.add_argument(
+        "--memory",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="Memory budget for the browsers, which caps how many run at the "
+        "same time. (default: one browser)",
+    )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        default=driverpool.DEFAULT_MAX_PAGES,
+        help="Number of pages a browser loads before it is restarted. "
+        "(default: {})".format(driverpool.DEFAULT_MAX_PAGES),
+    )
+
+    return parser.parse_args()
+
+
+def _parse_user_line(row):
+    if len(row) != 4:
+        raise InvalidUserLineError("Invalid user line: '{}'".format(",".join(row)))
+    school_id, user_type, user_id, calendar_name = [field.strip() for field in row]
+    if user_type not in lectio.USER_TYPE:
+        raise InvalidUserLineError("Invalid user type: '{}'".format(user_type))
+    return User(int(school_id), user_type, int(user_id), calendar_name)
+
+
+def read_users(path):
+    users = []
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        for row in csv.reader(file):
+            if not row or row[0].strip().startswith("#"):
+                continue
+            users.append(_parse_user_line(row))
+    return users
+
+
+def _print_summary(failed, n_users, lesson_caches):
+    print("SUMMARY:")
+    print(f"Synced {n_users - len(failed)} of {n_users} users")
+    for user, error in failed:
+        print(f"Failed: {user} ({type(error).__name__}: {error})")
+    for school_id, cache in sorted(lesson_caches.items()):
+        print(
+            f"Lesson cache for school {school_id}: {cache.hits} hits, "
+            f"{cache.misses} misses ({cache.hit_rate():.0%})"
+        )
+    tooltips = lectio.get_tooltip_cache_info()
+    print(
+        f"Tooltip cache: {tooltips.hits} hits, {tooltips.misses} misses, "
+        f"{tooltips.currsize}/{tooltips.maxsize} entries"
+    )
+
+
+def _sync_user(
+    user,
+    weeks,
+    show_top,
+    show_cancelled,
+    freshness,
+    lesson_cache,
+    schedule_sink,
+    driver_pool,
+    sync_window,
+    changelog_path,
+):
+    try:
+        run.sync(
+            user.school_id,
+            user.user_type,
+            user.user_id,
+            user.calendar_name,
+            weeks,
+            show_top,
+            show_cancelled,
+            freshness,
+            lesson_cache,
+            schedule_sink,
+            driver_pool,
+            sync_window,
+            changelog_path,
+        )
+    except (lectio.SessionExpiredError, lectio.UserDoesNotExistError) as e:
+        return e
+    except Exception as e:
+        print(f"An error occured for user ({user}):", file=sys.stderr)
+        traceback.print_exc()
+        return e
+    return None
+
+
+def sync_users(
+    users,
+    weeks,
+    show_top,
+    show_cancelled,
+    freshness=24,
+    ics_directory=None,
+    jobs=1,
+    driver_pool=None,
+    changelog_path=None,
+):
+    """
+    Sync the calendars of several users, sharing parsed lessons within schools
+    """
+    schedule_sink = run.get_sink(ics_directory, freshness)
+    # All users get the same weeks, even if the run crosses midnight
+    sync_window = syncwindow.SyncWindow(weeks)
+    lesson_caches = {user.school_id: lectio.LessonCache() for user in users}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        errors = executor.map(
+            lambda user: _sync_user(
+                user,
+                weeks,
+                show_top,
+                show_cancelled,
+                freshness,
+                lesson_caches[user.school_id],
+                schedule_sink,
+                driver_pool,
+                sync_window,
+                changelog_path,
+            ),
+            users,
+        )
+        failed = [
+            (user, error) for user, error in zip(users, errors) if error is not None
+        ]
+    _print_summary(failed, len(users), lesson_caches)
+    return failed
+
+
+def main():
+    a = _get_arguments()
+    users = read_users(a.users_file)
+    memory_budget = a.memory * 1024 * 1024 if a.memory else None
+    pool = driverpool.DriverPool(memory_budget, a.pages)
+    try:
+        failed = sync_users(
+            users,
+            a.weeks,
+            a.show_top,
+            a.show_cancelled,
+            a.freshness,
+            a.ics,
+            a.jobs,
+            pool,
+            a.changelog,
+        )
+    finally:
+        pool.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
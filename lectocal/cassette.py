@@ -0,0 +1,262 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+
+import google_auth_httplib2
+import httplib2
+from lxml import html
+
+from . import gcalendar
+from . import journal
+from . import lectio
+from . import syncwindow
+
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class CassetteExhaustedError(Exception):
+    """The replayed run made a request that wasn't recorded in the cassette."""
+
+
+class Cassette(object):
+    """Pages from Lectio and Calendar API exchanges of a recorded run."""
+
+    def __init__(
+        self, pages=None, exchanges=None, calendar_ids=None, today=None, utcnow=None
+    ):
+        self.pages = pages or []
+        self.exchanges = exchanges or []
+        self.calendar_ids = calendar_ids or {}
+        # The clock of the recorded run, which decides the weeks and freshness
+        self.today = today or datetime.date.today()
+        self.utcnow = utcnow or datetime.datetime.utcnow()
+        self._lock = threading.Lock()
+
+    def add_page(self, url, current_url, page_source):
+        with self._lock:
+            self.pages.append(
+                {"url": url, "current_url": current_url, "page_source": page_source}
+            )
+
+    def add_exchange(self, exchange):
+        with self._lock:
+            self.exchanges.append(exchange)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "pages": self.pages,
+                    "exchanges": self.exchanges,
+                    "calendar_ids": self.calendar_ids,
+                    "today": self.today.strftime(DATE_FORMAT),
+                    "utcnow": self.utcnow.strftime(TIME_FORMAT),
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as file:
+            content = json.load(file)
+        return cls(
+            content["pages"],
+            content["exchanges"],
+            content["calendar_ids"],
+            datetime.datetime.strptime(content["today"], DATE_FORMAT).date(),
+            datetime.datetime.strptime(content["utcnow"], TIME_FORMAT),
+        )
+
+
+def _decode(content):
+    if content is None:
+        return None
+    if isinstance(content, bytes):
+        return content.decode("utf-8")
+    return content
+
+
+def _get_exchange_key(method, uri):
+    # The time window in the query changes from day to day, so requests are
+    # matched on method and path, in the order they were recorded
+    return method, urllib.parse.urlsplit(uri).path
+
+
+class RecordingDriver(object):
+    """Driver that saves every loaded page in a cassette."""
+
+    def __init__(self, driver, cassette):
+        self._driver = driver
+        self._cassette = cassette
+
+    def get(self, url):
+        self._driver.get(url)
+        self._cassette.add_page(
+            url, self._driver.current_url, self._driver.page_source
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+
+class ReplayDriver(object):
+    """Driver that returns the pages of a cassette instead of using a browser."""
+
+    def __init__(self, pages):
+        self._pages = pages
+        self.current_url = None
+        self.page_source = None
+
+    def get(self, url):
+        try:
+            page = self._pages.popleft()
+        except IndexError:
+            raise CassetteExhaustedError("No recorded page for: {}".format(url))
+        self.current_url = page["current_url"]
+        self.page_source = page["page_source"]
+
+    def find_elements(self, by, value):
+        # Only the lookups by class name done in lectio are supported
+        return html.fromstring(self.page_source).find_class(value)
+
+    def quit(self):
+        pass
+
+
+class RecordingHttp(object):
+    """Http object that saves every Calendar API exchange in a cassette."""
+
+    def __init__(self, http, cassette):
+        self._http = http
+        self._cassette = cassette
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        response, content = self._http.request(
+            uri, method=method, body=body, headers=headers, **kwargs
+        )
+        self._cassette.add_exchange(
+            {
+                "method": method,
+                "uri": uri,
+                "body": _decode(body),
+                "status": response.status,
+                "headers": dict(response),
+                "content": _decode(content),
+            }
+        )
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+
+class ReplayHttp(object):
+    """Http object answering Calendar API requests from a cassette."""
+
+    def __init__(self, exchanges):
+        self._exchanges = collections.defaultdict(collections.deque)
+        for exchange in exchanges:
+            key = _get_exchange_key(exchange["method"], exchange["uri"])
+            self._exchanges[key].append(exchange)
+        self._lock = threading.Lock()
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        with self._lock:
+            try:
+                exchange = self._exchanges[_get_exchange_key(method, uri)].popleft()
+            except IndexError:
+                raise CassetteExhaustedError(
+                    "No recorded response for: {} {}".format(method, uri)
+                )
+        response_headers = dict(exchange["headers"])
+        response_headers["status"] = str(exchange["status"])
+        content = (exchange["content"] or "").encode("utf-8")
+        return httplib2.Response(response_headers), content
+
+
+@contextlib.contextmanager
+def _isolated_run(cassette):
+    """
+    Run with the clock of the cassette, and with journals in a temporary
+    directory, so a recorded or replayed run never resumes a real run or
+    leaves behind a journal that a real run would resume
+    """
+    journal_directory = journal.JOURNAL_DIRECTORY
+    temporary_directory = tempfile.mkdtemp(prefix="lectocal-")
+    journal.JOURNAL_DIRECTORY = os.path.join(temporary_directory, "journal")
+    syncwindow.frozen_clock = (cassette.today, cassette.utcnow)
+    try:
+        yield temporary_directory
+    finally:
+        journal.JOURNAL_DIRECTORY = journal_directory
+        syncwindow.frozen_clock = None
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def record(path):
+    """
+    Record the Lectio pages and Calendar API exchanges of the enclosed runs
+    """
+    cassette = Cassette(calendar_ids=dict(gcalendar._load_calendar_ids()))
+    lectio.driver_factory = lambda launch: RecordingDriver(launch(), cassette)
+    gcalendar.http_factory = lambda get_credentials: RecordingHttp(
+        google_auth_httplib2.AuthorizedHttp(get_credentials(), http=httplib2.Http()),
+        cassette,
+    )
+    try:
+        with _isolated_run(cassette):
+            yield cassette
+    finally:
+        lectio.driver_factory = None
+        gcalendar.http_factory = None
+        # Runs that failed are saved too, as those are often the interesting ones
+        cassette.save(path)
+
+
+@contextlib.contextmanager
+def replay(path):
+    """
+    Replay the enclosed runs from a cassette, without Lectio or Google
+    """
+    cassette = Cassette.load(path)
+    pages = collections.deque(cassette.pages)
+    replay_http = ReplayHttp(cassette.exchanges)
+    lectio.driver_factory = lambda launch: ReplayDriver(pages)
+    gcalendar.http_factory = lambda get_credentials: replay_http
+    # Ids are looked up from the cassette, not a calendars.json from another run
+    gcalendar.calendar_ids = dict(cassette.calendar_ids)
+    calendar_ids_file = gcalendar.CALENDAR_IDS_FILE
+    try:
+        with _isolated_run(cassette) as temporary_directory:
+            # Ids saved while replaying mustn't end up in the real calendars.json
+            gcalendar.CALENDAR_IDS_FILE = os.path.join(
+                temporary_directory, gcalendar.CALENDAR_IDS_FILE
+            )
+            yield cassette
+    finally:
+        lectio.driver_factory = None
+        gcalendar.http_factory = None
+        gcalendar.CALENDAR_IDS_FILE = calendar_ids_file
+        gcalendar.calendar_ids = None
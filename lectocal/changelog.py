@@ -0,0 +1,199 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import datetime
+import sqlite3
+import time
+from . import lesson
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    school_id INTEGER NOT NULL,
+    user_type TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    n_weeks INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    action TEXT NOT NULL,
+    lesson_id TEXT NOT NULL,
+    lesson_date TEXT,
+    weekday INTEGER,
+    week_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE INDEX IF NOT EXISTS changes_run_id ON changes (run_id);
+"""
+
+WEEKDAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+SQLITE_TIMEOUT = 60  # seconds
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _get_change_row(run_id, operation, first_day):
+    if operation.get("date") is None:
+        return run_id, operation["action"], operation["id"], None, None, None
+    lesson_date = datetime.datetime.strptime(operation["date"], "%Y-%m-%d").date()
+    week_offset = (lesson_date - first_day).days // 7
+    return (
+        run_id,
+        operation["action"],
+        operation["id"],
+        operation["date"],
+        lesson_date.weekday(),
+        week_offset,
+    )
+
+
+def record(path, school_id, user_type, user_id, sync_window, operations):
+    """
+    Append a run and the changes it made to the change log
+    """
+    # The last updated event changes with the time of the run, not the schedule
+    operations = [
+        operation
+        for operation in operations
+        if operation["id"] != lesson.LAST_UPDATED_ID
+    ]
+    connection = _connect(path)
+    try:
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (time, school_id, user_type, user_id, n_weeks) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (time.time(), school_id, user_type, user_id, sync_window.n_weeks),
+            )
+            connection.executemany(
+                "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    _get_change_row(cursor.lastrowid, operation, sync_window.first_day)
+                    for operation in operations
+                ],
+            )
+    finally:
+        connection.close()
+
+
+def _print_table(title, header, rows):
+    print(title)
+    widths = [
+        max(len(str(row[column])) for row in [header] + rows)
+        for column in range(len(header))
+    ]
+    for row in [header] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+    print()
+
+
+def _per_run(changes, runs):
+    return "{:.2f}".format(changes / runs) if runs else "-"
+
+
+def report(path, days):
+    """
+    Print how often schedules change, by school, weekday and weeks from today
+    """
+    connection = _connect(path)
+    since = time.time() - days * 24 * 60 * 60
+    try:
+        schools = connection.execute(
+            "SELECT runs.school_id, COUNT(DISTINCT runs.id), "
+            "COUNT(DISTINCT changes.run_id), COUNT(changes.run_id) "
+            "FROM runs LEFT JOIN changes ON changes.run_id = runs.id "
+            "WHERE runs.time >= ? GROUP BY runs.school_id ORDER BY runs.school_id",
+            (since,),
+        ).fetchall()
+        weekdays = connection.execute(
+            "SELECT changes.weekday, COUNT(*) FROM changes "
+            "JOIN runs ON changes.run_id = runs.id "
+            "WHERE runs.time >= ? AND changes.weekday IS NOT NULL "
+            "GROUP BY changes.weekday ORDER BY changes.weekday",
+            (since,),
+        ).fetchall()
+        max_weeks = connection.execute(
+            "SELECT MAX(n_weeks) FROM runs WHERE time >= ?", (since,)
+        ).fetchone()[0]
+        offsets = []
+        for week_offset in range((max_weeks or 0) + 1):
+            # Only runs covering the week count, as the number of weeks may vary
+            runs, changes = connection.execute(
+                "SELECT COUNT(DISTINCT runs.id), COUNT(changes.run_id) FROM runs "
+                "LEFT JOIN changes ON changes.run_id = runs.id "
+                "AND changes.week_offset = ? "
+                "WHERE runs.time >= ? AND runs.n_weeks >= ?",
+                (week_offset, since, week_offset),
+            ).fetchone()
+            offsets.append((week_offset, runs, changes, _per_run(changes, runs)))
+    finally:
+        connection.close()
+
+    _print_table(
+        "Changes by school:",
+        ["school", "runs", "runs with changes", "changes", "changes/run"],
+        [
+            [school_id, runs, changed_runs, changes, _per_run(changes, runs)]
+            for school_id, runs, changed_runs, changes in schools
+        ],
+    )
+    _print_table(
+        "Changes by weekday:",
+        ["weekday", "changes"],
+        [[WEEKDAYS[weekday], changes] for weekday, changes in weekdays],
+    )
+    _print_table(
+        "Changes by weeks from today:",
+        ["weeks", "runs", "changes", "changes/run"],
+        [list(row) for row in offsets],
+    )
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Summarizes how often Lectio schedules change, "
+        "from the change log written by lectocal --changelog."
+    )
+    parser.add_argument("changelog", help="Path to the SQLite change log.")
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=30,
+        help="Number of days back to include. (default: 30)",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    a = _get_arguments()
+    report(a.changelog, a.days)
+
+
+if __name__ == "__main__":
+    main()
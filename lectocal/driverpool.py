@@ -0,0 +1,225 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import threading
+from . import lectio
+
+DEFAULT_MAX_PAGES = 200
+DEFAULT_MAX_GROWTH = 2.0  # times the memory use after the first user
+DEFAULT_DRIVER_RSS = 300 * 1024 * 1024  # bytes, used until a driver is measured
+PROC_DIRECTORY = "/proc"
+PS_COMMAND = ["ps", "-A", "-o", "pid=,ppid=,rss="]
+has_warned = False  # only use in _warn_unmeasurable()
+
+
+def _get_parent_pids():
+    parents = {}
+    for name in os.listdir(PROC_DIRECTORY):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIRECTORY, name, "stat"), "r") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces, so split after it
+        fields = stat[stat.rindex(")") + 2 :].split()
+        parents[int(name)] = int(fields[1])
+    return parents
+
+
+def _get_rss(pid):
+    try:
+        with open(os.path.join(PROC_DIRECTORY, str(pid), "status"), "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _get_ps_processes():
+    """
+    Parent pid and memory use in bytes of each process, from ps on systems
+    without /proc such as macOS, or None if ps isn't available
+    """
+    try:
+        output = subprocess.run(
+            PS_COMMAND, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    processes = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and all(field.isdigit() for field in fields):
+            pid, parent, rss = map(int, fields)
+            processes[pid] = (parent, rss * 1024)
+    return processes
+
+
+def _warn_unmeasurable():
+    global has_warned
+    if not has_warned:
+        has_warned = True
+        print(
+            "Unable to measure the memory use of browsers, so --memory assumes "
+            f"{DEFAULT_DRIVER_RSS // (1024 * 1024)} MB per browser and browsers "
+            "are only restarted after --pages pages",
+            file=sys.stderr,
+        )
+
+
+def _get_process_tree_rss(pid):
+    """
+    Memory use in bytes of a process and all its descendants, or None if it
+    can't be measured on this system
+    """
+    if os.path.isdir(PROC_DIRECTORY):
+        parents = _get_parent_pids()
+        get_rss = _get_rss
+    else:
+        processes = _get_ps_processes()
+        if processes is None:
+            _warn_unmeasurable()
+            return None
+        parents = {process: parent for process, (parent, _) in processes.items()}
+
+        def get_rss(process):
+            return processes.get(process, (0, 0))[1]
+
+    tree = {pid}
+    added = True
+    while added:
+        children = {child for child, parent in parents.items() if parent in tree}
+        added = not children <= tree
+        tree |= children
+    return sum(get_rss(process) for process in tree)
+
+
+def _get_driver_rss(driver):
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return None
+    return _get_process_tree_rss(pid)
+
+
+class PooledDriver(object):
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+        self.baseline_rss = None  # memory use after the first user
+
+
+class DriverPool(object):
+    """
+    Warm browser drivers shared between users in a run.
+
+    The number of live browsers is capped so their memory use stays within
+    memory_budget (in bytes, None for a single browser), and a driver is
+    replaced after max_pages pages, or when its memory use has grown by
+    max_growth times since its first user, to contain leaks in the browser.
+    When the login is kept in the Brave profile, there's only a single browser.
+    """
+
+    def __init__(
+        self,
+        memory_budget=None,
+        max_pages=DEFAULT_MAX_PAGES,
+        max_growth=DEFAULT_MAX_GROWTH,
+    ):
+        self.memory_budget = memory_budget
+        self.max_pages = max_pages
+        self.max_growth = max_growth
+        self.driver_rss = None  # largest memory use measured for a driver
+        self.idle = []
+        self.in_use = {}
+        self.n_live = 0
+        self.condition = threading.Condition()
+
+    def _has_room(self):
+        if self.n_live == 0:
+            return True
+        # The login profile of Brave can only be open in one browser at a time
+        if self.memory_budget is None or lectio.has_login_profile():
+            return False
+        driver_rss = self.driver_rss or DEFAULT_DRIVER_RSS
+        return (self.n_live + 1) * driver_rss <= self.memory_budget
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and not self._has_room():
+                self.condition.wait()
+            if self.idle:
+                pooled = self.idle.pop()
+                self.in_use[id(pooled.driver)] = pooled
+                return pooled.driver
+            self.n_live += 1
+
+        try:
+            pooled = PooledDriver(lectio._get_driver())
+        except BaseException:
+            with self.condition:
+                self.n_live -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.in_use[id(pooled.driver)] = pooled
+        return pooled.driver
+
+    def _should_recycle(self, pooled, rss):
+        if pooled.pages >= self.max_pages:
+            return True
+        if rss is not None and pooled.baseline_rss:
+            return rss > pooled.baseline_rss * self.max_growth
+        return False
+
+    def release(self, driver, pages=1, is_broken=False):
+        with self.condition:
+            pooled = self.in_use.pop(id(driver))
+        pooled.pages += pages
+        rss = _get_driver_rss(driver)
+        if rss is not None:
+            if pooled.baseline_rss is None:
+                pooled.baseline_rss = rss
+            with self.condition:
+                self.driver_rss = max(self.driver_rss or 0, rss)
+
+        if is_broken or self._should_recycle(pooled, rss):
+            self._quit(driver)
+            with self.condition:
+                self.n_live -= 1
+                self.condition.notify()
+        else:
+            with self.condition:
+                self.idle.append(pooled)
+                self.condition.notify()
+
+    def _quit(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.n_live -= len(idle)
+        for pooled in idle:
+            self._quit(pooled.driver)
@@ -14,10 +14,12 @@
 
 import backoff
 import datetime
-import dateutil.parser
+import json
 import os.path
 import pkg_resources
 import pytz
+import tempfile
+import threading
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -25,41 +27,85 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from . import journal
 from . import lesson
+from . import syncwindow
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
+TOKEN_FILE = "token.json"
 
 
 SERVICE_NAME = "calendar"
 SERVICE_VERSION = "v3"
 
-service_object = None  # only use in _get_calendar_service()
+# The service isn't thread-safe, so each thread gets its own
+service_objects = threading.local()  # only use in _get_calendar_service()
+# The credentials are shared, so only one thread refreshes them or asks for consent
+credentials = None  # only use in _get_credentials()
+credentials_lock = threading.Lock()
+# If set, called with a function returning the credentials to make the http object
+# of new services, e.g. to record or replay the requests
+http_factory = None
+
+CALENDAR_IDS_FILE = "calendars.json"
+calendar_ids = None  # only use in _load_calendar_ids()
+calendar_ids_lock = threading.RLock()
 
 DEFAULT_TIME_ZONE = pytz.timezone("Europe/Copenhagen")
-LESSON_STATUS = {"7": "normal", "2": "changed", "11": "cancelled"}
+# Only the id, start and fingerprint of existing events are needed to compare them
+EVENT_FIELDS = "nextPageToken,items(id,etag,updated,start,extendedProperties/private)"
+# How often the last updated event is rewritten when nothing else has changed
+DEFAULT_FRESHNESS = datetime.timedelta(hours=24)
+# How old the journal of an interrupted run may be, for the run to be resumed
+JOURNAL_MAX_AGE = datetime.timedelta(hours=1)
 
 
-class CalendarNotFoundError(object):
+class CalendarNotFoundError(Exception):
     """To get the id of a calendar, the calendar must exist."""
 
 
-def _new_calendar_service():
-    creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                _get_client_secret_path(), SCOPES
-            )
-            creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
+def _save_token(creds):
+    # Written to a temporary file and moved into place, so another process never
+    # reads a partially written token
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(TOKEN_FILE)),
+        prefix=".",
+        suffix=".json.tmp",
+    )
+    try:
+        with os.fdopen(file_descriptor, "w") as token:
             token.write(creds.to_json())
+        os.replace(temporary_path, TOKEN_FILE)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def _get_credentials():
+    global credentials
+    with credentials_lock:
+        creds = credentials
+        if creds is None and os.path.exists(TOKEN_FILE):
+            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    _get_client_secret_path(), SCOPES
+                )
+                creds = flow.run_local_server(port=0)
+            _save_token(creds)
+        credentials = creds
+        return creds
 
-    return build(SERVICE_NAME, SERVICE_VERSION, credentials=creds)
+
+def _new_calendar_service():
+    if http_factory is not None:
+        http = http_factory(_get_credentials)
+        return build(SERVICE_NAME, SERVICE_VERSION, http=http)
+    return build(SERVICE_NAME, SERVICE_VERSION, credentials=_get_credentials())
 
 
 def _get_client_secret_path():
@@ -67,56 +113,94 @@ def _get_client_secret_path():
 
 
 def _get_calendar_service():
-    global service_object
-    if service_object is None:
-        service_object = _new_calendar_service()
-    return service_object
+    if getattr(service_objects, "service", None) is None:
+        service_objects.service = _new_calendar_service()
+    return service_objects.service
+
+
+def _read_calendar_ids_file():
+    if not os.path.exists(CALENDAR_IDS_FILE):
+        return {}
+    with open(CALENDAR_IDS_FILE, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _load_calendar_ids():
+    global calendar_ids
+    with calendar_ids_lock:
+        if calendar_ids is None:
+            calendar_ids = _read_calendar_ids_file()
+        return calendar_ids
+
+
+def _write_calendar_ids_file(ids):
+    # Several processes may share the file, so it is written to a temporary file
+    # and moved into place, and a reader never sees a partially written file.
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(CALENDAR_IDS_FILE)),
+        prefix=".",
+        suffix=".json.tmp",
+    )
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            json.dump(ids, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, CALENDAR_IDS_FILE)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def _save_calendar_id(calendar_name, calendar_id):
+    with calendar_ids_lock:
+        ids = _load_calendar_ids()
+        # Ids saved by other processes since the file was loaded are kept
+        for name, id in _read_calendar_ids_file().items():
+            ids.setdefault(name, id)
+        if calendar_id is None:
+            ids.pop(calendar_name, None)
+        else:
+            ids[calendar_name] = calendar_id
+        _write_calendar_ids_file(ids)
 
 
-def has_calendar(calendar_name):
-    service = _get_calendar_service()
+def _lookup_calendar_id(service, calendar_name):
     page_token = None
     while True:
         calendar_list = service.calendarList().list(pageToken=page_token).execute()
         for calendar_entry in calendar_list["items"]:
             if calendar_entry["summary"] == calendar_name:
-                return True
+                _save_calendar_id(calendar_name, calendar_entry["id"])
+                return calendar_entry["id"]
         page_token = calendar_list.get("nextPageToken")
         if not page_token:
-            return False
+            return None
+
+
+def has_calendar(calendar_name):
+    if calendar_name in _load_calendar_ids():
+        return True
+    service = _get_calendar_service()
+    return _lookup_calendar_id(service, calendar_name) is not None
 
 
 def create_calendar(calendar_name):
     calendar = {"summary": calendar_name, "timeZone": DEFAULT_TIME_ZONE.zone}
 
     service = _get_calendar_service()
-    service.calendars().insert(body=calendar).execute()
+    created = service.calendars().insert(body=calendar).execute()
+    _save_calendar_id(calendar_name, created["id"])
 
 
 def _get_calendar_id_for_name(service, calendar_name):
-    page_token = None
-    while True:
-        calendar_list = service.calendarList().list(pageToken=page_token).execute()
-        for calendar_entry in calendar_list["items"]:
-            if calendar_entry["summary"] == calendar_name:
-                return calendar_entry["id"]
-        page_token = calendar_list.get("nextPageToken")
-        if not page_token:
-            raise CalendarNotFoundError("Calendar: {} not found".format(calendar_name))
-
-
-def _get_first_time_of_week():
-    today = datetime.date.today()
-    days_since_first_weekday = datetime.timedelta(days=today.weekday())
-    first_day_this_week = today - days_since_first_weekday
-    return datetime.datetime.combine(first_day_this_week, datetime.time.min)
-
-
-def _get_last_time_in_n_weeks(n):
-    today_n_weeks = datetime.date.today() + datetime.timedelta(weeks=n)
-    days_to_week_end = datetime.timedelta(days=(6 - today_n_weeks.weekday()))
-    last_day_n_weeks = today_n_weeks + days_to_week_end
-    return datetime.datetime.combine(last_day_n_weeks, datetime.time.max)
+    # The ids are kept in a local file, so a run doesn't need to list calendars
+    calendar_id = _load_calendar_ids().get(calendar_name)
+    if calendar_id is None:
+        calendar_id = _lookup_calendar_id(service, calendar_name)
+    if calendar_id is None:
+        raise CalendarNotFoundError("Calendar: {} not found".format(calendar_name))
+    return calendar_id
 
 
 def _get_events_in_date_range(service, calendar_id, start, end):
@@ -128,8 +212,9 @@ def _get_events_in_date_range(service, calendar_id, start, end):
             .list(
                 calendarId=calendar_id,
                 pageToken=page_token,
-                timeMax=DEFAULT_TIME_ZONE.localize(end).isoformat(),
-                timeMin=DEFAULT_TIME_ZONE.localize(start).isoformat(),
+                timeMax=end.isoformat(),
+                timeMin=start.isoformat(),
+                fields=EVENT_FIELDS,
             )
             .execute()
         )
@@ -140,114 +225,303 @@ def _get_events_in_date_range(service, calendar_id, start, end):
     return all_events
 
 
-def _get_status_from_color(colorId):
-    try:
-        return LESSON_STATUS[colorId]
-    except KeyError:
-        return "invalid status"  # to get the event removed
+class RemoteEvent(object):
+    """The parts of an event in Google Calendar needed to compare it to a lesson."""
 
+    def __init__(self, id, etag, updated, start, fingerprint, field_digests):
+        self.id = id
+        self.etag = etag
+        self.updated = updated
+        self.start = start
+        self.fingerprint = fingerprint
+        self.field_digests = field_digests
 
-def _get_datetime_from_field(field):
-    return dateutil.parser.parse(field, ignoretz=True)
+    def __repr__(self):
+        return str({"id": self.id, "fingerprint": self.fingerprint})
+
+
+def _get_utc_time_from_field(field):
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.datetime.strptime(field, time_format)
+        except ValueError:
+            pass
+    return None
 
 
 def _get_date_from_field(field):
-    return dateutil.parser.parse(field, ignoretz=True).date()
-
-
-def _parse_event_to_lesson(event):
-    id = event["id"]
-    summary = event["summary"]
-    status = _get_status_from_color(event["colorId"])
-    if "dateTime" in event["start"]:
-        start = _get_datetime_from_field(event["start"]["dateTime"])
-    else:
-        start = _get_date_from_field(event["start"]["date"])
-    if "dateTime" in event["end"]:
-        end = _get_datetime_from_field(event["end"]["dateTime"])
-    else:
-        end = _get_date_from_field(event["end"]["date"])
-    location = event.get("location", None)
-    description = event.get("description", None)
-    if "source" in event and "url" in event["source"]:
-        link = event["source"]["url"]
-    else:
-        link = None
-    return lesson.Lesson(id, summary, status, start, end, location, description, link)
+    # Both dates and date-times start with the date in ISO format
+    value = field.get("date") or field.get("dateTime") or ""
+    try:
+        return datetime.datetime.strptime(value[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_event_to_remote_event(event):
+    private = event.get("extendedProperties", {}).get("private", {})
+    field_digests = {
+        key[len(lesson.FIELD_DIGEST_PREFIX) :]: value
+        for key, value in private.items()
+        if key.startswith(lesson.FIELD_DIGEST_PREFIX)
+    }
+    return RemoteEvent(
+        event["id"],
+        event.get("etag", None),
+        _get_utc_time_from_field(event.get("updated", "")),
+        _get_date_from_field(event.get("start", {})),
+        private.get(lesson.FINGERPRINT_PROPERTY, None),
+        field_digests,
+    )
 
 
 def _parse_events_to_schedule(events):
     schedule = []
     for event in events:
-        schedule.append(_parse_event_to_lesson(event))
+        schedule.append(_parse_event_to_remote_event(event))
     return schedule
 
 
-def get_schedule(calendar_name, n_weeks):
+def get_schedule(calendar_name, n_weeks, sync_window=None):
+    if sync_window is None:
+        sync_window = syncwindow.SyncWindow(n_weeks)
     service = _get_calendar_service()
     calendar_id = _get_calendar_id_for_name(service, calendar_name)
-    start = _get_first_time_of_week()
-    end = _get_last_time_in_n_weeks(n_weeks)
-    events = _get_events_in_date_range(service, calendar_id, start, end)
+    start = sync_window.start
+    end = sync_window.end
+    try:
+        events = _get_events_in_date_range(service, calendar_id, start, end)
+    except HttpError as err:
+        # Status code 404 is not found. In this case, it means the stored id of the
+        # calendar is outdated, so look it up again, or create the calendar if it
+        # was deleted.
+        if err.resp.status == 404:
+            _save_calendar_id(calendar_name, None)
+            if not has_calendar(calendar_name):
+                create_calendar(calendar_name)
+            calendar_id = _get_calendar_id_for_name(service, calendar_name)
+            events = _get_events_in_date_range(service, calendar_id, start, end)
+        else:
+            raise err
     return _parse_events_to_schedule(events)
 
 
 @backoff.on_exception(backoff.expo, HttpError, max_tries=4)
 def _delete_lesson(service, calendar_id, lesson_id):
-    service.events().delete(calendarId=calendar_id, eventId=lesson_id).execute()
+    try:
+        service.events().delete(calendarId=calendar_id, eventId=lesson_id).execute()
+    except HttpError as err:
+        # Status code 404 and 410 are not found and gone. In this case, it means the
+        # event was already deleted, e.g. by a run that was interrupted.
+        if err.resp.status not in (404, 410):
+            raise err
 
 
 @backoff.on_exception(backoff.expo, HttpError, max_tries=4)
-def _add_lesson(service, calendar_id, lesson):
+def _add_lesson(service, calendar_id, body):
     try:
-        service.events().insert(
-            calendarId=calendar_id, body=lesson.to_gcalendar_format()
-        ).execute()
+        service.events().insert(calendarId=calendar_id, body=body).execute()
     except HttpError as err:
         # Status code 409 is conflict. In this case, it means the id already exists.
         if err.resp.status == 409:
-            _update_lesson(service, calendar_id, lesson)
+            _update_lesson(service, calendar_id, body)
         else:
             raise err
 
 
 @backoff.on_exception(backoff.expo, HttpError, max_tries=4)
-def _update_lesson(service, calendar_id, lesson):
+def _update_lesson(service, calendar_id, body):
     service.events().update(
-        calendarId=calendar_id, eventId=lesson.id, body=lesson.to_gcalendar_format()
+        calendarId=calendar_id, eventId=body["id"], body=body
     ).execute()
 
 
-def _print_action(action, lesson):
-    print(f"{action.upper()}:\n{lesson}\n\n")
+@backoff.on_exception(backoff.expo, HttpError, max_tries=4)
+def _patch_lesson(service, calendar_id, lesson_id, body, etag=None):
+    request = service.events().patch(
+        calendarId=calendar_id, eventId=lesson_id, body=body
+    )
+    if etag is not None:
+        request.headers["If-Match"] = etag
+    try:
+        request.execute()
+    except HttpError as err:
+        # Status code 412 is precondition failed. In this case, it means the event
+        # was changed by someone else since it was read, so leave it for next run.
+        if err.resp.status == 412:
+            _print_action("skipped (changed remotely)", lesson_id, body)
+        else:
+            raise err
 
 
-def _delete_removed_lessons(service, calendar_id, old_schedule, new_schedule):
-    for old_lesson in old_schedule:
-        if not any(new_lesson.id == old_lesson.id for new_lesson in new_schedule):
-            _delete_lesson(service, calendar_id, old_lesson.id)
-            _print_action("removed", old_lesson)
+def _print_action(action, lesson_id, body=None, fields=None):
+    if fields:
+        action += " (" + ", ".join(fields) + ")"
+    print(f"{action.upper()}:\n{body or lesson_id}\n\n")
 
 
-def _add_new_lessons(service, calendar_id, old_schedule, new_schedule):
-    for new_lesson in new_schedule:
-        if not any(old_lesson.id == new_lesson.id for old_lesson in old_schedule):
-            _add_lesson(service, calendar_id, new_lesson)
-            _print_action("added", new_lesson)
+def _get_start_date(start):
+    # Operations are journaled as JSON, so the date is kept as a string
+    if start is None:
+        return None
+    if isinstance(start, datetime.datetime):
+        start = start.date()
+    return start.isoformat()
 
 
-def _update_current_lessons(service, calendar_id, old_schedule, new_schedule):
+def _plan_updated_lessons(old_schedule, new_schedule):
+    operations = []
     for new_lesson in new_schedule:
         for old_lesson in old_schedule:
             if new_lesson.id == old_lesson.id:
-                if new_lesson != old_lesson:
-                    _update_lesson(service, calendar_id, new_lesson)
-                    _print_action("updated", new_lesson)
+                if new_lesson.fingerprint() != old_lesson.fingerprint:
+                    fields = new_lesson.changed_fields(old_lesson.field_digests)
+                    formatted = new_lesson.to_gcalendar_format()
+                    body = {field: formatted[field] for field in fields}
+                    body["extendedProperties"] = formatted["extendedProperties"]
+                    operations.append(
+                        {
+                            "action": "updated",
+                            "id": new_lesson.id,
+                            "date": _get_start_date(new_lesson.start),
+                            "body": body,
+                            "fields": fields,
+                            "etag": old_lesson.etag,
+                        }
+                    )
+    return operations
+
+
+def _plan_new_lessons(old_schedule, new_schedule):
+    operations = []
+    for new_lesson in new_schedule:
+        if not any(old_lesson.id == new_lesson.id for old_lesson in old_schedule):
+            operations.append(
+                {
+                    "action": "added",
+                    "id": new_lesson.id,
+                    "date": _get_start_date(new_lesson.start),
+                    "body": new_lesson.to_gcalendar_format(),
+                }
+            )
+    return operations
+
+
+def _plan_removed_lessons(old_schedule, new_schedule):
+    operations = []
+    for old_lesson in old_schedule:
+        if not any(new_lesson.id == old_lesson.id for new_lesson in new_schedule):
+            operations.append(
+                {
+                    "action": "removed",
+                    "id": old_lesson.id,
+                    "date": _get_start_date(old_lesson.start),
+                }
+            )
+    return operations
+
+
+def _plan_changes(old_schedule, new_schedule):
+    return (
+        _plan_updated_lessons(old_schedule, new_schedule)
+        + _plan_new_lessons(old_schedule, new_schedule)
+        + _plan_removed_lessons(old_schedule, new_schedule)
+    )
+
+
+def _apply_operation(service, calendar_id, operation):
+    action = operation["action"]
+    if action == "updated":
+        _patch_lesson(
+            service,
+            calendar_id,
+            operation["id"],
+            operation["body"],
+            operation["etag"],
+        )
+        _print_action(action, operation["id"], operation["body"], operation["fields"])
+    elif action == "added":
+        _add_lesson(service, calendar_id, operation["body"])
+        _print_action(action, operation["id"], operation["body"])
+    elif action == "removed":
+        _delete_lesson(service, calendar_id, operation["id"])
+        _print_action(action, operation["id"])
+
+
+def _apply_operations(service, calendar_id, journal, operations):
+    for index, operation in operations:
+        _apply_operation(service, calendar_id, operation)
+        journal.mark_done(index)
+    journal.clear()
+
+
+def resume_interrupted_sync(calendar_name, max_age=JOURNAL_MAX_AGE):
+    """
+    Finish the writes of an interrupted run, if its journal is still fresh.
+    Returns whether a run was resumed.
+    """
+    sync_journal = journal.Journal(calendar_name)
+    operations = sync_journal.pending(max_age)
+    # A run killed after its last write but before clearing the journal has
+    # nothing left to resume, so it is treated as not interrupted
+    if not operations:
+        sync_journal.clear()
+        return False
+    service = _get_calendar_service()
+    calendar_id = _get_calendar_id_for_name(service, calendar_name)
+    _apply_operations(service, calendar_id, sync_journal, operations)
+    return True
+
+
+def _has_changes(old_schedule, new_schedule):
+    old_fingerprints = {
+        old_lesson.id: old_lesson.fingerprint for old_lesson in old_schedule
+    }
+    new_fingerprints = {
+        new_lesson.id: new_lesson.fingerprint() for new_lesson in new_schedule
+    }
+    return old_fingerprints != new_fingerprints
 
 
-def update_calendar_with_schedule(calendar_name, old_schedule, new_schedule):
+def _is_fresh(remote_event, freshness):
+    if remote_event.updated is None:
+        return False
+    return syncwindow.get_utcnow() - remote_event.updated < freshness
+
+
+def _split_last_updated_event(schedule):
+    last_updated = None
+    others = []
+    for entry in schedule:
+        if entry.id == lesson.LAST_UPDATED_ID:
+            last_updated = entry
+        else:
+            others.append(entry)
+    return last_updated, others
+
+
+def update_calendar_with_schedule(
+    calendar_name, old_schedule, new_schedule, freshness=DEFAULT_FRESHNESS
+):
+    old_last_updated, old_lessons = _split_last_updated_event(old_schedule)
+    _, new_lessons = _split_last_updated_event(new_schedule)
+    # Keep the last updated event as it is, unless something else changed or it
+    # has become stale, so a run without changes doesn't write anything.
+    if (
+        old_last_updated is not None
+        and _is_fresh(old_last_updated, freshness)
+        and not _has_changes(old_lessons, new_lessons)
+    ):
+        old_schedule, new_schedule = old_lessons, new_lessons
+
+    operations = _plan_changes(old_schedule, new_schedule)
+    if not operations:
+        return operations
+
     service = _get_calendar_service()
     calendar_id = _get_calendar_id_for_name(service, calendar_name)
-    _update_current_lessons(service, calendar_id, old_schedule, new_schedule)
-    _add_new_lessons(service, calendar_id, old_schedule, new_schedule)
-    _delete_removed_lessons(service, calendar_id, old_schedule, new_schedule)
+    # The planned operations are journaled, so an interrupted run can be resumed
+    sync_journal = journal.Journal(calendar_name)
+    sync_journal.start(operations)
+    _apply_operations(service, calendar_id, sync_journal, enumerate(operations))
+    return operations
@@ -0,0 +1,191 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+
+from . import lesson
+
+TIME_ZONE = "Europe/Copenhagen"
+FINGERPRINT_PROPERTY = "X-LECTOCAL-FINGERPRINT"
+MAX_LINE_OCTETS = 75
+NAME_HASH_LENGTH = 8
+# CSS color names (RFC 7986) closest to the Google Calendar colors of the statuses
+GCALENDAR_COLOR_NAMES = {"7": "deepskyblue", "2": "mediumseagreen", "11": "red"}
+
+VTIMEZONE = [
+    "BEGIN:VTIMEZONE",
+    "TZID:" + TIME_ZONE,
+    "BEGIN:DAYLIGHT",
+    "TZOFFSETFROM:+0100",
+    "TZOFFSETTO:+0200",
+    "TZNAME:CEST",
+    "DTSTART:19700329T020000",
+    "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU",
+    "END:DAYLIGHT",
+    "BEGIN:STANDARD",
+    "TZOFFSETFROM:+0200",
+    "TZOFFSETTO:+0100",
+    "TZNAME:CET",
+    "DTSTART:19701025T030000",
+    "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU",
+    "END:STANDARD",
+    "END:VTIMEZONE",
+]
+
+
+def get_path(directory, calendar_name):
+    # Different names can give the same safe name, e.g. "Lectio A" and
+    # "Lectio_A", so a short hash of the full name keeps their files apart
+    safe_name = re.sub(r"[^\w.-]", "_", calendar_name)
+    name_hash = hashlib.sha256(bytes(calendar_name, "utf8")).hexdigest()
+    return os.path.join(
+        directory, "{}-{}.ics".format(safe_name, name_hash[:NAME_HASH_LENGTH])
+    )
+
+
+def _escape_text(text):
+    text = text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+    return text.replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def _fold_line(line):
+    # Lines longer than 75 octets are continued on lines starting with a space,
+    # without splitting the UTF-8 encoding of a character.
+    folded = []
+    current = ""
+    current_octets = 0
+    for character in line:
+        octets = len(character.encode("utf-8"))
+        if current_octets + octets > MAX_LINE_OCTETS:
+            folded.append(current)
+            current = " "
+            current_octets = 1
+        current += character
+        current_octets += octets
+    folded.append(current)
+    return "\r\n".join(folded)
+
+
+def _format_time(name, value, is_end=False):
+    if isinstance(value, datetime.datetime):
+        return "{};TZID={}:{}".format(name, TIME_ZONE, value.strftime("%Y%m%dT%H%M%S"))
+    if is_end:
+        # The end date of an all day event is exclusive in iCalendar
+        value += datetime.timedelta(days=1)
+    return "{};VALUE=DATE:{}".format(name, value.strftime("%Y%m%d"))
+
+
+def _lesson_to_event_lines(feed_lesson, timestamp):
+    lines = [
+        "BEGIN:VEVENT",
+        "UID:{}@lectocal".format(feed_lesson.id),
+        "DTSTAMP:" + timestamp,
+        _format_time("DTSTART", feed_lesson.start),
+        _format_time("DTEND", feed_lesson.end, is_end=True),
+        "SUMMARY:" + _escape_text(feed_lesson.summary),
+    ]
+    color_id = lesson.STATUS_COLORS[feed_lesson.status]
+    lines.append("COLOR:" + GCALENDAR_COLOR_NAMES[color_id])
+    if feed_lesson.status == "cancelled":
+        lines.append("STATUS:CANCELLED")
+    if feed_lesson.location:
+        lines.append("LOCATION:" + _escape_text(feed_lesson.location))
+    if feed_lesson.description:
+        lines.append("DESCRIPTION:" + _escape_text(feed_lesson.description))
+    if feed_lesson.link:
+        lines.append("URL:" + feed_lesson.link)
+    lines.append("END:VEVENT")
+    return lines
+
+
+def _get_fingerprint(schedule):
+    fingerprints = sorted(
+        feed_lesson.id + feed_lesson.fingerprint() for feed_lesson in schedule
+    )
+    return hashlib.sha256(bytes("".join(fingerprints), "utf8")).hexdigest()
+
+
+def _read_fingerprint(path):
+    if not os.path.exists(path):
+        return None
+    header = ""
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        for line in file:
+            if line.startswith("BEGIN:VEVENT"):
+                break
+            header += line
+    prefix = FINGERPRINT_PROPERTY + ":"
+    for line in header.replace("\r\n ", "").splitlines():
+        if line.startswith(prefix):
+            return line[len(prefix) :]
+    return None
+
+
+def _schedule_to_calendar(calendar_name, schedule, fingerprint):
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//LecToCal//LecToCal//DA",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:" + _escape_text(calendar_name),
+        "X-WR-TIMEZONE:" + TIME_ZONE,
+        FINGERPRINT_PROPERTY + ":" + fingerprint,
+    ]
+    lines += VTIMEZONE
+    for feed_lesson in schedule:
+        lines += _lesson_to_event_lines(feed_lesson, timestamp)
+    lines.append("END:VCALENDAR")
+    return "".join(_fold_line(line) + "\r\n" for line in lines)
+
+
+def write_schedule(directory, calendar_name, schedule):
+    """
+    Write the schedule to an iCalendar file, if its content has changed.
+    Returns whether the file was written.
+    """
+    # The last updated event changes on every run, so it's left out of the feed
+    # to only rewrite the file when the lessons change.
+    schedule = [
+        feed_lesson
+        for feed_lesson in schedule
+        if feed_lesson.id != lesson.LAST_UPDATED_ID
+    ]
+    path = get_path(directory, calendar_name)
+    fingerprint = _get_fingerprint(schedule)
+    if _read_fingerprint(path) == fingerprint:
+        return False
+
+    content = _schedule_to_calendar(calendar_name, schedule, fingerprint)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file next to the feed and move it into place, so
+    # readers never see a partially written feed.
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix=".", suffix=".ics.tmp"
+    )
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8", newline="") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return True
@@ -0,0 +1,83 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import hashlib
+import json
+import os
+
+JOURNAL_DIRECTORY = "journal"
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class Journal(object):
+    """
+    Planned operations for a calendar and which of them have been completed.
+
+    The file has the plan on its first line and the index of each completed
+    operation on the following lines, so it can be appended to as the run goes.
+    """
+
+    def __init__(self, calendar_name):
+        name = hashlib.sha256(bytes(calendar_name, "utf8")).hexdigest()
+        self.path = os.path.join(JOURNAL_DIRECTORY, name + ".jsonl")
+
+    def start(self, operations):
+        os.makedirs(JOURNAL_DIRECTORY, exist_ok=True)
+        plan = {
+            "created": datetime.datetime.utcnow().strftime(TIME_FORMAT),
+            "operations": operations,
+        }
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(json.dumps(plan) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+    def mark_done(self, index):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"done": index}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def pending(self, max_age):
+        """
+        Operations not yet completed, or None if there's no journal younger
+        than max_age
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        try:
+            plan = json.loads(lines[0])
+            done = set()
+            for line in lines[1:]:
+                done.add(json.loads(line)["done"])
+        except (IndexError, ValueError, KeyError):
+            # The run was killed while the journal was being written
+            return None
+        created = datetime.datetime.strptime(plan["created"], TIME_FORMAT)
+        if datetime.datetime.utcnow() - created > max_age:
+            return None
+        return [
+            (index, operation)
+            for index, operation in enumerate(plan["operations"])
+            if index not in done
+        ]
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
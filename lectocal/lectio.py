@@ -12,28 +12,49 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
 import datetime
+import functools
+import hashlib
 import os
 import re
+import threading
 import time
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from lxml import html
-from .lesson import Lesson
+from . import syncwindow
+from .lesson import LAST_UPDATED_ID, Lesson, gen_stable_id
 
 
 USER_TYPE = {"student": "elev", "teacher": "laerer"}
 LESSON_STATUS = {None: "normal", "Ændret!": "changed", "Aflyst!": "cancelled"}
 URL_TEMPLATE = "https://www.lectio.dk/lectio/{0}/SkemaNy.aspx?{1}id={2}&week={3}"
 LOGIN_URL_TEMPLATE = "https://www.lectio.dk/lectio/{0}/login.aspx"
+SESSION_CHECK_URL_TEMPLATE = "https://www.lectio.dk/lectio/{0}/forside.aspx"
+SESSION_CHECK_INTERVAL = 600  # seconds
 SPACER = " " + "\u2022" + " "
+TOOLTIP_CACHE_SIZE = 4096
+# Brave keeps the Lectio login from --login in this profile in the working
+# directory, and only one browser at a time can use it
+BRAVE_PROFILE_DIRECTORY = "data-dir"
 cookies = None
+session_checks = {}  # school id -> (time of check, session is valid)
+working_browser = None  # only use in _launch_driver()
+# If set, called with a function launching a browser to make the drivers, e.g. to
+# record or replay the pages
+driver_factory = None
 
 
 class UserDoesNotExistError(Exception):
     """Attempted to get a non-existing user from Lectio."""
 
 
+class SessionExpiredError(Exception):
+    """The login session for the school has expired. Log in again with --login."""
+
+
 class CookiesNotSet(Exception):
     """Cookies not set. Login before you retrieve calendar pages."""
 
@@ -68,15 +89,6 @@ def _get_user_page(driver, school_id, user_type, user_id, week):
     return driver.page_source
 
 
-def _get_lectio_weekformat_with_offset(offset):
-    today = datetime.date.today()
-    future_date = today + datetime.timedelta(weeks=offset)
-    week_number = "{0:02d}".format(future_date.isocalendar()[1])
-    year_number = str(future_date.isocalendar()[0])
-    lectio_week = week_number + year_number
-    return lectio_week
-
-
 def _get_id_from_link(link):
     match = re.search(r"(?:absid|ProeveholdId|outboundCensorID|aftaleid)=(\d+)", link)
     if match is None:
@@ -220,6 +232,9 @@ def _prepend_section_to_summary(section, summary):
     return summary
 
 
+# The parsed info is a tuple of immutable values (strings, dates and None), so
+# the cached results can be handed out to every caller without being copied.
+@functools.lru_cache(maxsize=TOOLTIP_CACHE_SIZE)
 def _extract_lesson_info(tooltip):
     summary = description = event_title = groups = ressources = ""
     status = start_time = end_time = location = None
@@ -282,39 +297,111 @@ def _extract_lesson_info(tooltip):
     if description == "":  # needed for comparison
         description = None
 
-    return summary, status, start_time, end_time, location, description, is_top
+    # Lessons without an id in their link are identified by their time slot,
+    # group and title, so a change in e.g. status gives an update instead of a
+    # new lesson
+    identity = (groups, event_title)
+
+    return (
+        summary,
+        status,
+        start_time,
+        end_time,
+        location,
+        description,
+        is_top,
+        identity,
+    )
+
 
+class LessonCache(object):
+    """Lessons already built in this run, shared by the users of a school."""
 
-def _parse_element_to_lesson(element, show_top, show_cancelled):
-    link = element.get("href")
+    def __init__(self):
+        self.lessons = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            if key in self.lessons:
+                self.hits += 1
+                return self.lessons[key]
+        value = build()
+        with self._lock:
+            self.misses += 1
+            return self.lessons.setdefault(key, value)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def _get_cache_key(link, tooltip):
+    id = _get_id_from_link(link) if link else None
+    if id is None:
+        id = hashlib.sha256(bytes(str(tooltip), "utf8")).hexdigest()
+    # The prevurl part of a link names the user and week it was shown for, so
+    # it is left out to let the users of a school share the lesson
+    return id, _get_complete_link(link) if link else None
+
+
+def _build_lesson(link, tooltip):
     id = None
     if link:
         id = _get_id_from_link(link)
         link = _get_complete_link(link)
-    tooltip = element.get("data-tooltip")
-    summary, status, start_time, end_time, location, description, is_top = (
-        _extract_lesson_info(tooltip)
+    (
+        summary,
+        status,
+        start_time,
+        end_time,
+        location,
+        description,
+        is_top,
+        identity,
+    ) = _extract_lesson_info(tooltip)
+    if id is None:
+        id = gen_stable_id(start_time, end_time, identity)
+
+    # if not location:
+    #     return None, is_top  ####################################################################
+    # TODO: Do this better
+    if (end_time - start_time).days > 5:
+        return None, is_top  ######################################################################
+    # TODO: Do this better
+    location = None  ##############################################################################
+    # TODO: Undo this
+    lesson = Lesson(
+        id, summary, status, start_time, end_time, location, description, link
     )
+    return lesson, is_top
+
+
+def get_tooltip_cache_info():
+    return _extract_lesson_info.cache_info()
+
+
+def _parse_element_to_lesson(element, show_top, show_cancelled, lesson_cache=None):
+    link = element.get("href")
+    tooltip = element.get("data-tooltip")
+    if lesson_cache is None:
+        lesson, is_top = _build_lesson(link, tooltip)
+    else:
+        lesson, is_top = lesson_cache.get_or_build(
+            _get_cache_key(link, tooltip), lambda: _build_lesson(link, tooltip)
+        )
 
     if not show_top and is_top:
         return None
-    elif not show_cancelled and status == "cancelled":
+    elif lesson is not None and not show_cancelled and lesson.status == "cancelled":
         return None
-    # elif not location:
-    #     return None  ############################################################################
-    # TODO: Do this better
-    elif (end_time - start_time).days > 5:
-        return None  ##############################################################################
-    # TODO: Do this better
     else:
-        location = None  ##########################################################################
-        # TODO: Undo this
-        return Lesson(
-            id, summary, status, start_time, end_time, location, description, link
-        )
+        return lesson
 
 
-def _parse_page_to_lessons(page_source, show_top, show_cancelled):
+def _parse_page_to_lessons(page_source, show_top, show_cancelled, lesson_cache=None):
     tree = html.fromstring(page_source)
     # Find all a elements with class s2skemabrik in page
     lesson_elements = tree.xpath(
@@ -322,17 +409,28 @@ def _parse_page_to_lessons(page_source, show_top, show_cancelled):
     )
     lessons = []
     for element in lesson_elements:
-        lesson = _parse_element_to_lesson(element, show_top, show_cancelled)
+        lesson = _parse_element_to_lesson(
+            element, show_top, show_cancelled, lesson_cache
+        )
         if lesson is not None:
             lessons.append(lesson)
     return lessons
 
 
 def _retreive_week_schedule(
-    driver, school_id, user_type, user_id, week, show_top, show_cancelled
+    driver,
+    school_id,
+    user_type,
+    user_id,
+    week,
+    show_top,
+    show_cancelled,
+    lesson_cache=None,
 ):
     page_source = _get_user_page(driver, school_id, user_type, user_id, week=week)
-    schedule = _parse_page_to_lessons(page_source, show_top, show_cancelled)
+    schedule = _parse_page_to_lessons(
+        page_source, show_top, show_cancelled, lesson_cache
+    )
     return schedule
 
 
@@ -344,13 +442,30 @@ def _filter_for_duplicates(schedule):
     return filtered_schedule
 
 
-def _last_updated_event():
-    id = "updated"
+def _make_ids_unique(schedule):
+    """
+    Give lessons sharing an id a unique one, so no event overwrites another
+    """
+    # Lessons without an id in their link can still share time slot, group and
+    # title. Later ones get a counter in their id, in the order of the pages.
+    seen = collections.Counter()
+    unique_schedule = []
+    for lesson in schedule:
+        n_seen = seen[lesson.id]
+        seen[lesson.id] += 1
+        if n_seen:
+            # Lessons may be shared between users, so a copy is changed
+            lesson = copy.copy(lesson)
+            lesson.id = gen_stable_id(lesson.start, lesson.end, (lesson.id, n_seen))
+        unique_schedule.append(lesson)
+    return unique_schedule
+
+
+def _last_updated_event(monday):
+    id = LAST_UPDATED_ID
     summary = "Opdateret " + datetime.datetime.now().strftime("%d/%m %H:%M")
     status = None
 
-    now = datetime.datetime.now()
-    monday = (now - datetime.timedelta(days=now.weekday())).date()
     start_time = end_time = monday
 
     description = None
@@ -366,56 +481,155 @@ def _not_on_a_schedule_page(driver):
     return len(driver.find_elements(By.CLASS_NAME, "tidsreg-wrapper")) == 0
 
 
+def _get_known_session_status(school_id):
+    check = session_checks.get(school_id)
+    if check is None or time.time() - check[0] > SESSION_CHECK_INTERVAL:
+        return None
+    return check[1]
+
+
+def _raise_session_expired(school_id):
+    raise SessionExpiredError(
+        f"Session expired for school: {school_id} - log in again with --login."
+    )
+
+
+def _has_login(driver):
+    # Browsers started in place of Brave don't have the login from its profile
+    return not getattr(driver, "lacks_login", False)
+
+
+def _save_session_status(driver, school_id, is_valid):
+    # A browser without the login says nothing about the session of the school,
+    # so it mustn't mark the school as expired for the browsers that have it
+    if is_valid or _has_login(driver):
+        session_checks[school_id] = (time.time(), is_valid)
+
+
+def _check_session(driver, school_id):
+    """
+    Check once per school that the login session is valid, by loading a light
+    page which redirects to the login page for expired sessions.
+    """
+    is_valid = _get_known_session_status(school_id)
+    if is_valid is None:
+        driver.get(SESSION_CHECK_URL_TEMPLATE.format(school_id))
+        is_valid = "login.aspx" not in driver.current_url.lower()
+        _save_session_status(driver, school_id, is_valid)
+    if not is_valid:
+        _raise_session_expired(school_id)
+
+
 def _retreive_user_schedule(
-    driver, school_id, user_type, user_id, n_weeks, show_top, show_cancelled
+    driver,
+    school_id,
+    user_type,
+    user_id,
+    sync_window,
+    show_top,
+    show_cancelled,
+    lesson_cache=None,
 ):
     schedule = []
-    for week_offset in range(n_weeks + 1):
-        week = _get_lectio_weekformat_with_offset(week_offset)
+    for week_offset, week in enumerate(sync_window.weeks):
         week_schedule = _retreive_week_schedule(
-            driver, school_id, user_type, user_id, week, show_top, show_cancelled
+            driver,
+            school_id,
+            user_type,
+            user_id,
+            week,
+            show_top,
+            show_cancelled,
+            lesson_cache,
         )
         if week_offset == 0 and _not_on_a_schedule_page(driver):
+            # The session can expire after it was last checked, in which case
+            # Lectio redirects to the login page rather than the schedule
+            if "login.aspx" in driver.current_url.lower():
+                _save_session_status(driver, school_id, False)
+                _raise_session_expired(school_id)
             raise UserDoesNotExistError(
-                f"Couldn't log in user - school: {school_id}, type: {user_type}, id: {user_id} - in Lectio."
+                f"User not found - school: {school_id}, type: {user_type}, id: {user_id} - in Lectio."
             )
         schedule += week_schedule
-    filtered_schedule = _filter_for_duplicates(schedule)
-    filtered_schedule.append(_last_updated_event())
+    filtered_schedule = _make_ids_unique(_filter_for_duplicates(schedule))
+    filtered_schedule.append(_last_updated_event(sync_window.first_day))
     return filtered_schedule
 
 
-def _get_driver(headless=True):
-    driver = None
-    try:
-        options = webdriver.ChromeOptions()
-        options.binary_location = (
-            "/Applications/Brave Browser.app/Contents/MacOS/Brave Browser"
-        )
-        options.add_argument(f"--user-data-dir={os.getcwd()}/data-dir")
-        if headless:
-            options.add_argument("--headless=new")
-        driver = webdriver.Chrome(options=options)
-        print("Using Brave")
-    except Exception:
+def _get_brave_profile_path():
+    return os.path.join(os.getcwd(), BRAVE_PROFILE_DIRECTORY)
+
+
+def has_login_profile():
+    """
+    Whether the login is kept in the Brave profile, which allows only one
+    browser at a time
+    """
+    return os.path.isdir(_get_brave_profile_path())
+
+
+def _new_brave_driver(headless):
+    options = webdriver.ChromeOptions()
+    options.binary_location = (
+        "/Applications/Brave Browser.app/Contents/MacOS/Brave Browser"
+    )
+    options.add_argument(f"--user-data-dir={_get_brave_profile_path()}")
+    if headless:
+        options.add_argument("--headless=new")
+    return webdriver.Chrome(options=options)
+
+
+def _new_chrome_driver(headless):
+    options = webdriver.ChromeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+    return webdriver.Chrome(options=options)
+
+
+def _new_firefox_driver(headless):
+    options = webdriver.FirefoxOptions()
+    if headless:
+        options.add_argument("-headless")
+    return webdriver.Firefox(options=options)
+
+
+BROWSERS = [
+    ("Brave", _new_brave_driver),
+    ("Chrome", _new_chrome_driver),
+    ("Firefox", _new_firefox_driver),
+]
+
+
+def _launch_driver(headless):
+    global working_browser
+    if has_login_profile():
+        # Only Brave has the login, so it's always tried first, even if it
+        # failed to start before, e.g. while another process had the profile
+        browsers = BROWSERS
+    else:
+        # Try the browser that worked last time first, so failing browsers
+        # earlier in the list don't cost a launch attempt for every driver
+        browsers = sorted(BROWSERS, key=lambda browser: browser[0] != working_browser)
+    for name, new_driver in browsers:
         try:
-            options = webdriver.ChromeOptions()
-            if headless:
-                options.add_argument("--headless=new")
-            driver = webdriver.Chrome(options=options)
-            print("Using Chrome")
+            driver = new_driver(headless)
         except Exception:
-            try:
-                options = webdriver.FirefoxOptions()
-                if headless:
-                    options.add_argument("-headless")
-                driver = webdriver.Firefox(options=options)
-                print("Using Firefox")
-            except Exception:
-                raise Exception(
-                    "Unable to open browser (tried Brave, Chrome and Firefox)"
-                )
-    return driver
+            continue
+        if name != "Brave" and has_login_profile():
+            print(f"Unable to open Brave, using {name} without the Lectio login")
+            driver.lacks_login = True
+        elif name != working_browser:
+            print(f"Using {name}")
+            working_browser = name
+        return driver
+    raise Exception("Unable to open browser (tried Brave, Chrome and Firefox)")
+
+
+def _get_driver(headless=True):
+    if driver_factory is not None:
+        return driver_factory(lambda: _launch_driver(headless))
+    return _launch_driver(headless)
 
 
 def login(school_id):
@@ -437,15 +651,67 @@ def login(school_id):
             driver.quit()
 
 
-def get_schedule(school_id, user_type, user_id, n_weeks, show_top, show_cancelled):
+def get_schedule(
+    school_id,
+    user_type,
+    user_id,
+    n_weeks,
+    show_top,
+    show_cancelled,
+    lesson_cache=None,
+    driver_pool=None,
+    sync_window=None,
+):
+    if sync_window is None:
+        sync_window = syncwindow.SyncWindow(n_weeks)
+
+    # Skip users of schools with a dead session without starting a browser
+    if _get_known_session_status(school_id) is False:
+        _raise_session_expired(school_id)
+
+    if driver_pool is None:
+        driver = None
+        try:
+            driver = _get_driver()
+            _check_session(driver, school_id)
+            return _retreive_user_schedule(
+                driver,
+                school_id,
+                user_type,
+                user_id,
+                sync_window,
+                show_top,
+                show_cancelled,
+                lesson_cache,
+            )
+        finally:
+            if driver is not None:
+                driver.quit()
+
+    driver = driver_pool.acquire()
+    is_broken = True
     try:
-        driver = _get_driver()
-        return _retreive_user_schedule(
-            driver, school_id, user_type, user_id, n_weeks, show_top, show_cancelled
+        _check_session(driver, school_id)
+        schedule = _retreive_user_schedule(
+            driver,
+            school_id,
+            user_type,
+            user_id,
+            sync_window,
+            show_top,
+            show_cancelled,
+            lesson_cache,
         )
+        is_broken = False
+        return schedule
+    except (SessionExpiredError, UserDoesNotExistError):
+        is_broken = False
+        raise
     finally:
-        if driver is not None:
-            driver.quit()
+        # A driver that failed may be in any state, so it isn't reused
+        driver_pool.release(
+            driver, pages=len(sync_window.weeks) + 1, is_broken=is_broken
+        )
 
 
 def main():
@@ -464,7 +730,8 @@ def main():
 
     schedule = _parse_page_to_lessons(page_source, False, False)
 
-    r = _filter_for_duplicates(schedule) + [_last_updated_event()]
+    monday = syncwindow.SyncWindow(0).first_day
+    r = _filter_for_duplicates(schedule) + [_last_updated_event(monday)]
 
     # for i in r:
     #     print(i)
@@ -15,8 +15,13 @@
 import copy
 import hashlib
 import datetime
+import json
 
 STATUS_COLORS = {"normal": "7", "changed": "2", "cancelled": "11"}
+FINGERPRINT_PROPERTY = "lectocalFingerprint"
+FIELD_DIGEST_PREFIX = "lectocal."
+FIELD_DIGEST_LENGTH = 16
+LAST_UPDATED_ID = "updated"
 
 
 class Lesson(object):
@@ -34,7 +39,7 @@ class Lesson(object):
         else:
             self.id = id
 
-    def to_gcalendar_format(self):
+    def _format_fields(self):
         TEMPLATE = {
             "summary": None,
             "id": None,
@@ -64,6 +69,31 @@ class Lesson(object):
             formatted["source"]["url"] = self.link
         return formatted
 
+    def to_gcalendar_format(self):
+        formatted = self._format_fields()
+        private = {FINGERPRINT_PROPERTY: self.fingerprint()}
+        for field, digest in self.field_digests().items():
+            private[FIELD_DIGEST_PREFIX + field] = digest
+        formatted["extendedProperties"] = {"private": private}
+        return formatted
+
+    def field_digests(self):
+        """
+        Short digest of each Google Calendar field, used to tell which changed
+        """
+        digests = {}
+        for field, value in self._format_fields().items():
+            if field != "id":
+                normalized = json.dumps(value, sort_keys=True)
+                digests[field] = hashlib.sha256(
+                    bytes(normalized, "utf8")
+                ).hexdigest()[:FIELD_DIGEST_LENGTH]
+        return digests
+
+    def fingerprint(self):
+        normalized = json.dumps(self.field_digests(), sort_keys=True)
+        return hashlib.sha256(bytes(normalized, "utf8")).hexdigest()
+
     def _gen_id(self):
         lesson_string = (
             str(self.summary)
@@ -79,6 +109,16 @@ class Lesson(object):
         hash_value = hasher.hexdigest()
         return hash_value
 
+    def changed_fields(self, field_digests):
+        """
+        Names of the Google Calendar fields that differ from the given digests
+        """
+        return [
+            field
+            for field, digest in self.field_digests().items()
+            if field_digests.get(field) != digest
+        ]
+
     def __eq__(self, other):
         if isinstance(other, Lesson):
             return self.__dict__ == other.__dict__
@@ -102,6 +142,16 @@ class Lesson(object):
         )
 
 
+def gen_stable_id(start, end, identity):
+    """
+    Id of a lesson that doesn't change when the content of the lesson changes
+    """
+    lesson_string = str(start) + str(end) + str(identity)
+    hasher = hashlib.sha256()
+    hasher.update(bytes(lesson_string, "utf8"))
+    return hasher.hexdigest()
+
+
 def schedules_are_identical(schedule1, schedule2):
     return all(lesson in schedule1 for lesson in schedule2) and all(
         lesson in schedule2 for lesson in schedule1
@@ -0,0 +1,166 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import tarfile
+from . import lectio
+
+PAGE_EXTENSIONS = (".html", ".htm")
+CHUNK_SIZE = 16
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Parses saved Lectio schedule pages "
+        "and writes the lessons as JSON lines."
+    )
+    parser.add_argument(
+        "source", help="Directory or tarball containing saved schedule pages."
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of parser processes. (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--showtop",
+        default=False,
+        dest="show_top",
+        action="store_true",
+        help="If set, include events from the Lectio's header.",
+    )
+    parser.add_argument(
+        "--showcancelled",
+        default=False,
+        dest="show_cancelled",
+        action="store_true",
+        help="If set, include cancelled events.",
+    )
+
+    return parser.parse_args()
+
+
+def _is_page_name(name):
+    return name.lower().endswith(PAGE_EXTENSIONS)
+
+
+def _get_page_paths(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if _is_page_name(name):
+                yield os.path.join(root, name)
+
+
+def _get_tarball_pages(path):
+    # Members are read here and handed to the workers, since an open tarball
+    # can't be shared between processes.
+    with tarfile.open(path, "r:*") as tarball:
+        for member in tarball:
+            if member.isfile() and _is_page_name(member.name):
+                # Decoded by the worker, so a page that isn't UTF-8 is skipped
+                # like any other malformed page
+                yield member.name, tarball.extractfile(member).read()
+
+
+def _lessons_to_json_lines(name, page_source, show_top, show_cancelled):
+    lessons = lectio._parse_page_to_lessons(page_source, show_top, show_cancelled)
+    return [
+        json.dumps({"page": name, "lesson": lesson.to_gcalendar_format()})
+        for lesson in lessons
+    ]
+
+
+def _parse_page_file(path, show_top, show_cancelled):
+    with open(path, "r", encoding="utf-8") as file:
+        page_source = file.read()
+    return _lessons_to_json_lines(path, page_source, show_top, show_cancelled)
+
+
+def _parse_page_content(page, show_top, show_cancelled):
+    name, content = page
+    page_source = content.decode("utf-8")
+    return _lessons_to_json_lines(name, page_source, show_top, show_cancelled)
+
+
+def _get_page_name(page):
+    # Pages are paths when parsing a directory and (name, content) from a tarball
+    return page if isinstance(page, str) else page[0]
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _parse_chunk(parse, chunk, show_top, show_cancelled):
+    lines = []
+    for page in chunk:
+        # A malformed page is reported and skipped, so it doesn't stop a backfill
+        try:
+            lines += parse(page, show_top, show_cancelled)
+        except Exception as e:
+            print(
+                f"Failed to parse page {_get_page_name(page)} "
+                f"({type(e).__name__}: {e})",
+                file=sys.stderr,
+            )
+    return lines
+
+
+def parse_pages(source, processes=None, show_top=False, show_cancelled=False):
+    """
+    Parse all pages in a directory or tarball, yielding one JSON line per lesson
+    """
+    if os.path.isdir(source):
+        parse, pages = _parse_page_file, _get_page_paths(source)
+    else:
+        parse, pages = _parse_page_content, _get_tarball_pages(source)
+
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        # Only keep a few chunks per process in flight, so a large archive isn't
+        # read into memory before the results start streaming out.
+        max_pending = processes * 2
+        pending = collections.deque()
+        for chunk in _chunks(pages, CHUNK_SIZE):
+            pending.append(
+                executor.submit(_parse_chunk, parse, chunk, show_top, show_cancelled)
+            )
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main():
+    a = _get_arguments()
+    for line in parse_pages(a.source, a.processes, a.show_top, a.show_cancelled):
+        sys.stdout.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,13 +13,66 @@
 # limitations under the License.
 
 import argparse
+import contextlib
+import cProfile
+import datetime
 import sys
+from . import cassette
+from . import changelog
 from . import lectio
-from . import gcalendar
+from . import sink
+from . import syncwindow
 
 KEYRING_SERVICE_NAME = "LecToCal"
 
 
+def add_sync_arguments(parser):
+    """
+    Add the options for how schedules are synced, shared by all commands
+    """
+    parser.add_argument(
+        "--weeks",
+        type=int,
+        default=4,
+        help="Number of weeks to parse the schedule for. " "(default: 4)",
+    )
+    parser.add_argument(
+        "--showtop",
+        default=False,
+        dest="show_top",
+        action="store_true",
+        help="If set, sync events from the Lectio's header to Google Calendar.",
+    )
+    parser.add_argument(
+        "--showcancelled",
+        default=False,
+        dest="show_cancelled",
+        action="store_true",
+        help="If set, sync cancelled events to Google Calendar.",
+    )
+    parser.add_argument(
+        "--freshness",
+        type=float,
+        default=24,
+        help="Hours between rewrites of the last updated event when nothing "
+        "else has changed. Use 0 to rewrite it on every run. (default: 24)",
+    )
+    parser.add_argument(
+        "--ics",
+        default=None,
+        metavar="DIRECTORY",
+        help="If set, write calendars as iCalendar files in the directory "
+        "instead of syncing them to Google Calendar.",
+    )
+    parser.add_argument(
+        "--changelog",
+        default=None,
+        metavar="FILE",
+        help="If set, log every added, updated and removed lesson in the SQLite "
+        "file, for use with lectocal-report.",
+    )
+
+
 def _get_arguments():
     parser = argparse.ArgumentParser(
         description="Scrapes a Lectio schedule " "and syncs it to Google Calendar."
@@ -46,46 +99,118 @@ def _get_arguments():
         help="Name to use for the calendar inside "
         "Google Calendar. (default: Lectio)",
     )
-    parser.add_argument(
-        "--weeks",
-        type=int,
-        default=4,
-        help="Number of weeks to parse the schedule for. " "(default: 4)",
+    add_sync_arguments(parser)
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record",
+        default=None,
+        metavar="CASSETTE",
+        help="If set, save all pages from Lectio and requests to Google Calendar "
+        "in the file, so the run can be replayed.",
     )
-    parser.add_argument(
-        "--showtop",
-        default=False,
-        dest="show_top",
-        action="store_true",
-        help="If set, sync events from the Lectio's header to Google Calendar.",
+    cassette_group.add_argument(
+        "--replay",
+        default=None,
+        metavar="CASSETTE",
+        help="If set, run from the pages and responses saved in the file, "
+        "without Lectio or Google Calendar.",
     )
     parser.add_argument(
-        "--showcancelled",
-        default=False,
-        dest="show_cancelled",
-        action="store_true",
-        help="If set, sync cancelled events to Google Calendar.",
+        "--profile",
+        default=None,
+        metavar="FILE",
+        help="If set, profile the run and save the result in the file. Uses "
+        "pyinstrument if the file name ends with .html, otherwise cProfile.",
     )
 
     return parser.parse_args()
 
 
-def sync(school_id, user_type, user_id, calendar_name, weeks, show_top, show_cancelled):
+def get_sink(ics_directory=None, freshness=24):
+    if ics_directory is not None:
+        return sink.IcsSink(ics_directory)
+    return sink.GoogleCalendarSink(datetime.timedelta(hours=freshness))
+
+
+def sync(
+    school_id,
+    user_type,
+    user_id,
+    calendar_name,
+    weeks,
+    show_top,
+    show_cancelled,
+    freshness=24,
+    lesson_cache=None,
+    schedule_sink=None,
+    driver_pool=None,
+    sync_window=None,
+    changelog_path=None,
+):
     """
-    Sync calendar from Lectio to Google
+    Sync calendar from Lectio to Google, or to another sink
     """
-    if not gcalendar.has_calendar(calendar_name):
-        gcalendar.create_calendar(calendar_name)
+    if schedule_sink is None:
+        schedule_sink = get_sink(freshness=freshness)
+    if sync_window is None:
+        sync_window = syncwindow.SyncWindow(weeks)
+
+    if schedule_sink.resume(calendar_name):
+        return
 
     lectio_schedule = lectio.get_schedule(
-        school_id, user_type, user_id, weeks, show_top, show_cancelled
+        school_id,
+        user_type,
+        user_id,
+        weeks,
+        show_top,
+        show_cancelled,
+        lesson_cache,
+        driver_pool,
+        sync_window,
     )
 
-    google_schedule = gcalendar.get_schedule(calendar_name, weeks)
+    operations = schedule_sink.write(calendar_name, sync_window, lectio_schedule)
 
-    gcalendar.update_calendar_with_schedule(
-        calendar_name, google_schedule, lectio_schedule
-    )
+    # Sinks that can't tell which lessons changed return None, and their runs
+    # are left out so they don't dilute the churn of the others
+    if changelog_path is not None and operations is not None:
+        changelog.record(
+            changelog_path, school_id, user_type, user_id, sync_window, operations
+        )
+
+
+@contextlib.contextmanager
+def _profile(path):
+    if path is None:
+        yield
+    elif path.endswith(".html"):
+        import pyinstrument  # optional, only needed for html profiles
+
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+
+def _use_cassette(record_path, replay_path):
+    if record_path is not None:
+        return cassette.record(record_path)
+    if replay_path is not None:
+        return cassette.replay(replay_path)
+    return contextlib.nullcontext()
 
 
 def main():
@@ -95,15 +220,19 @@ def main():
         if a.login:
             lectio.login(a.school_id)
         else:
-            sync(
-                a.school_id,
-                a.user_type,
-                a.user_id,
-                a.calendar,
-                a.weeks,
-                a.show_top,
-                a.show_cancelled,
-            )
+            with _use_cassette(a.record, a.replay), _profile(a.profile):
+                sync(
+                    a.school_id,
+                    a.user_type,
+                    a.user_id,
+                    a.calendar,
+                    a.weeks,
+                    a.show_top,
+                    a.show_cancelled,
+                    a.freshness,
+                    schedule_sink=get_sink(a.ics, a.freshness),
+                    changelog_path=a.changelog,
+                )
     except Exception as e:
         message = "An error occured. If it continues, then submit an issue with the following dump:"
         print(message + "\n", file=sys.stderr)
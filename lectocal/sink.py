@@ -0,0 +1,62 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from . import gcalendar
+from . import ics
+
+
+class GoogleCalendarSink(object):
+    """
+    Syncs schedules to calendars in Google Calendar.
+
+    write returns the operations applied to the calendar.
+    """
+
+    def __init__(self, freshness=gcalendar.DEFAULT_FRESHNESS):
+        self.freshness = freshness
+
+    def resume(self, calendar_name):
+        return gcalendar.resume_interrupted_sync(calendar_name)
+
+    def write(self, calendar_name, sync_window, schedule):
+        if not gcalendar.has_calendar(calendar_name):
+            gcalendar.create_calendar(calendar_name)
+
+        google_schedule = gcalendar.get_schedule(
+            calendar_name, sync_window.n_weeks, sync_window
+        )
+
+        return gcalendar.update_calendar_with_schedule(
+            calendar_name, google_schedule, schedule, self.freshness
+        )
+
+
+class IcsSink(object):
+    """
+    Writes schedules to an iCalendar file per calendar in a directory.
+
+    write returns None, as the whole file is rewritten rather than each lesson.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def resume(self, calendar_name):
+        # Files are written in one go, so there is never anything to resume
+        return False
+
+    def write(self, calendar_name, sync_window, schedule):
+        if ics.write_schedule(self.directory, calendar_name, schedule):
+            print(f"WROTE:\n{ics.get_path(self.directory, calendar_name)}\n\n")
+        return None
@@ -0,0 +1,70 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import pytz
+
+TIME_ZONE = pytz.timezone("Europe/Copenhagen")
+
+# If set, the (date, UTC time) to use instead of the clock, e.g. so a replayed
+# run sees the same weeks and freshness as when it was recorded
+frozen_clock = None
+
+
+def get_today():
+    if frozen_clock is not None:
+        return frozen_clock[0]
+    return datetime.date.today()
+
+
+def get_utcnow():
+    if frozen_clock is not None:
+        return frozen_clock[1]
+    return datetime.datetime.utcnow()
+
+
+def _get_lectio_weekformat(day):
+    year, week, _ = day.isocalendar()
+    return "{0:02d}{1}".format(week, year)
+
+
+class SyncWindow(object):
+    """
+    The weeks to sync, computed once so Lectio and Google agree on them.
+
+    Everything is derived from the Monday of the current week, so a run that
+    crosses midnight or a year boundary still fetches and compares the same
+    weeks on both sides.
+    """
+
+    def __init__(self, n_weeks, today=None):
+        if today is None:
+            today = get_today()
+        self.n_weeks = n_weeks
+        self.first_day = today - datetime.timedelta(days=today.weekday())
+        self.last_day = self.first_day + datetime.timedelta(weeks=n_weeks, days=6)
+        # Weeks in Lectio's format, e.g. "532020" for ISO week 53 of 2020
+        self.weeks = [
+            _get_lectio_weekformat(self.first_day + datetime.timedelta(weeks=offset))
+            for offset in range(n_weeks + 1)
+        ]
+        self.start = TIME_ZONE.localize(
+            datetime.datetime.combine(self.first_day, datetime.time.min)
+        ).astimezone(pytz.utc)
+        self.end = TIME_ZONE.localize(
+            datetime.datetime.combine(self.last_day, datetime.time.max)
+        ).astimezone(pytz.utc)
+
+    def __repr__(self):
+        return str({"weeks": self.weeks, "start": self.start, "end": self.end})
@@ -0,0 +1,285 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from . import batch
+from . import driverpool
+from . import run
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    school_id INTEGER NOT NULL,
+    user_type TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    calendar_name TEXT NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (school_id, user_type, user_id, calendar_name)
+);
+CREATE TABLE IF NOT EXISTS schools (
+    school_id INTEGER PRIMARY KEY,
+    last_claimed REAL NOT NULL
+);
+"""
+
+# Of the jobs that are due and not leased by a live worker, take one from the
+# school that was served longest ago, so a slow school can't starve the others.
+CLAIM_QUERY = """
+SELECT jobs.id, jobs.school_id, jobs.user_type, jobs.user_id, jobs.calendar_name
+FROM jobs LEFT JOIN schools ON jobs.school_id = schools.school_id
+WHERE jobs.not_before <= :now
+AND (jobs.lease_owner IS NULL OR jobs.lease_expires < :now)
+ORDER BY COALESCE(schools.last_claimed, 0), jobs.not_before
+LIMIT 1
+"""
+
+DEFAULT_LEASE = 600  # seconds
+IDLE_SLEEP = 10  # seconds
+MAX_RETRY_DELAY = 3600  # seconds
+SQLITE_TIMEOUT = 60  # seconds
+
+
+class Job(object):
+    def __init__(self, id, school_id, user_type, user_id, calendar_name):
+        self.id = id
+        self.school_id = school_id
+        self.user_type = user_type
+        self.user_id = user_id
+        self.calendar_name = calendar_name
+
+    def __repr__(self):
+        return "job: {}, school: {}, type: {}, id: {}, calendar: {}".format(
+            self.id, self.school_id, self.user_type, self.user_id, self.calendar_name
+        )
+
+
+class Queue(object):
+    """Queue of user sync jobs in an SQLite database shared by the workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+
+    def _connect(self):
+        # Transactions are handled explicitly, so claims can take the write lock
+        # before reading with BEGIN IMMEDIATE.
+        return sqlite3.connect(
+            self.path,
+            timeout=SQLITE_TIMEOUT,
+            isolation_level=None,
+        )
+
+    def enqueue(self, user):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO jobs (school_id, user_type, user_id, calendar_name) "
+            "VALUES (?, ?, ?, ?)",
+            (user.school_id, user.user_type, user.user_id, user.calendar_name),
+        )
+
+    def claim(self, owner, lease):
+        now = time.time()
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            row = cursor.execute(CLAIM_QUERY, {"now": now}).fetchone()
+            if row is None:
+                cursor.execute("COMMIT")
+                return None
+            job = Job(*row)
+            cursor.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_expires = ? WHERE id = ?",
+                (owner, now + lease, job.id),
+            )
+            cursor.execute(
+                "INSERT OR REPLACE INTO schools (school_id, last_claimed) "
+                "VALUES (?, ?)",
+                (job.school_id, now),
+            )
+            cursor.execute("COMMIT")
+            return job
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def extend(self, job, owner, lease):
+        self.connection.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+            (time.time() + lease, job.id, owner),
+        )
+
+    def complete(self, job, owner, interval):
+        self.connection.execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL, "
+            "not_before = ?, failures = 0 WHERE id = ? AND lease_owner = ?",
+            (time.time() + interval, job.id, owner),
+        )
+
+    def fail(self, job, owner, interval):
+        # Retry failed jobs sooner than the interval, but back off on repeats
+        self.connection.execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL, "
+            "not_before = ? + MIN(?, ? * (1 << MIN(failures, 16))), "
+            "failures = failures + 1 WHERE id = ? AND lease_owner = ?",
+            (time.time(), MAX_RETRY_DELAY, IDLE_SLEEP, job.id, owner),
+        )
+
+    def release(self, job, owner):
+        self.connection.execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL "
+            "WHERE id = ? AND lease_owner = ?",
+            (job.id, owner),
+        )
+
+
+class Heartbeat(threading.Thread):
+    """Extends the lease of a job while it is being worked on."""
+
+    def __init__(self, queue_path, job, owner, lease):
+        super().__init__(daemon=True)
+        self.queue_path = queue_path
+        self.job = job
+        self.owner = owner
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        queue = Queue(self.queue_path)
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                queue.extend(self.job, self.owner, self.lease)
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Syncs Lectio schedules to Google Calendar for users in a "
+        "queue shared by several workers."
+    )
+    parser.add_argument("queue", help="Path to the SQLite queue database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add users to the queue.")
+    enqueue_parser.add_argument(
+        "users_file",
+        help="CSV file with one user per line: "
+        "school_id,user_type,user_id,calendar",
+    )
+
+    work_parser = subparsers.add_parser("work", help="Sync users from the queue.")
+    work_parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Minutes between syncs of the same user. (default: 60)",
+    )
+    work_parser.add_argument(
+        "--lease",
+        type=int,
+        default=DEFAULT_LEASE,
+        help="Seconds a job is leased for between heartbeats, before other "
+        "workers may take it over. (default: {})".format(DEFAULT_LEASE),
+    )
+    run.add_sync_arguments(work_parser)
+
+    return parser.parse_args()
+
+
+def _get_worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def _work_on_job(queue, job, owner, schedule_sink, driver_pool, a):
+    heartbeat = Heartbeat(queue.path, job, owner, a.lease)
+    heartbeat.start()
+    try:
+        run.sync(
+            job.school_id,
+            job.user_type,
+            job.user_id,
+            job.calendar_name,
+            a.weeks,
+            a.show_top,
+            a.show_cancelled,
+            a.freshness,
+            schedule_sink=schedule_sink,
+            driver_pool=driver_pool,
+            changelog_path=a.changelog,
+        )
+    except Exception:
+        print(f"An error occured for {job}:", file=sys.stderr)
+        traceback.print_exc()
+        queue.fail(job, owner, a.interval * 60)
+    else:
+        queue.complete(job, owner, a.interval * 60)
+    finally:
+        heartbeat.stop()
+
+
+def work(a):
+    """
+    Sync users from the queue until interrupted
+    """
+    queue = Queue(a.queue)
+    owner = _get_worker_name()
+    schedule_sink = run.get_sink(a.ics, a.freshness)
+    # A warm browser is kept between jobs
+    driver_pool = driverpool.DriverPool()
+    try:
+        while True:
+            job = queue.claim(owner, a.lease)
+            if job is None:
+                time.sleep(IDLE_SLEEP)
+                continue
+            try:
+                _work_on_job(queue, job, owner, schedule_sink, driver_pool, a)
+            except BaseException:
+                # Hand the job back right away, instead of waiting for the lease
+                queue.release(job, owner)
+                raise
+    finally:
+        driver_pool.close()
+
+
+def enqueue(queue_path, users_file):
+    queue = Queue(queue_path)
+    for user in batch.read_users(users_file):
+        queue.enqueue(user)
+
+
+def main():
+    a = _get_arguments()
+    if a.command == "enqueue":
+        enqueue(a.queue, a.users_file)
+    else:
+        work(a)
+
+
+if __name__ == "__main__":
+    main()
@@ -48,7 +48,6 @@ setup(
         "google-auth-oauthlib",
         "keyring",
         "lxml",
-        "python-dateutil",
         "pytz",
         "selenium",
     ],
@@ -57,5 +56,13 @@ setup(
             "credentials.json",
         ]
     },
-    entry_points={"console_scripts": ["lectocal=lectocal.run:main"]},
+    entry_points={
+        "console_scripts": [
+            "lectocal=lectocal.run:main",
+            "lectocal-batch=lectocal.batch:main",
+            "lectocal-parse=lectocal.offline:main",
+            "lectocal-report=lectocal.changelog:main",
+            "lectocal-worker=lectocal.worker:main",
+        ]
+    },
 )
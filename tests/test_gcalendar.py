@@ -0,0 +1,144 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+import pytest
+
+from lectocal import gcalendar
+from lectocal import lesson
+from lectocal import sink
+from lectocal import syncwindow
+
+CALENDAR_NAME = "Lectio"
+TODAY = datetime.date(2026, 1, 7)
+LINK = "https://www.lectio.dk/lectio/1/aktivitet/aktivitetforside2.aspx?absid=123"
+
+
+class FakeRequest(object):
+    def __init__(self, response=None):
+        self.response = response
+        self.headers = {}
+
+    def execute(self):
+        return self.response
+
+
+class FakeEvents(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        self.service.calls.append("events.list")
+        return FakeRequest({"items": self.service.items})
+
+    def insert(self, **kwargs):
+        self.service.calls.append("events.insert")
+        return FakeRequest({})
+
+    def update(self, **kwargs):
+        self.service.calls.append("events.update")
+        return FakeRequest({})
+
+    def patch(self, **kwargs):
+        self.service.calls.append("events.patch")
+        return FakeRequest({})
+
+    def delete(self, **kwargs):
+        self.service.calls.append("events.delete")
+        return FakeRequest({})
+
+
+class FakeService(object):
+    """Calendar service that records the calls made to it."""
+
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def events(self):
+        return FakeEvents(self)
+
+    def calendars(self):
+        raise AssertionError("The calendar should be known from the cache")
+
+    def calendarList(self):
+        raise AssertionError("The calendar should be known from the cache")
+
+
+def _get_schedule(summary="1a Ma"):
+    sync_window = syncwindow.SyncWindow(1, today=TODAY)
+    start = datetime.datetime(2026, 1, 7, 8, 0)
+    return [
+        lesson.Lesson(
+            "123",
+            summary,
+            None,
+            start,
+            start + datetime.timedelta(hours=1),
+            None,
+            None,
+            LINK,
+        ),
+        lesson.Lesson(
+            lesson.LAST_UPDATED_ID,
+            "Opdateret 07/01 07:00",
+            None,
+            sync_window.first_day,
+            sync_window.first_day,
+            None,
+            None,
+            None,
+        ),
+    ]
+
+
+def _to_remote_item(scheduled_lesson):
+    body = scheduled_lesson.to_gcalendar_format()
+    return {
+        "id": body["id"],
+        "etag": '"1"',
+        "updated": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "start": body["start"],
+        "extendedProperties": body["extendedProperties"],
+    }
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # Journals and calendars.json are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gcalendar, "calendar_ids", {CALENDAR_NAME: "calendar-id"})
+    fake = FakeService([_to_remote_item(entry) for entry in _get_schedule()])
+    monkeypatch.setattr(gcalendar.service_objects, "service", fake, raising=False)
+    return fake
+
+
+def _write(schedule):
+    sync_window = syncwindow.SyncWindow(1, today=TODAY)
+    return sink.GoogleCalendarSink().write(CALENDAR_NAME, sync_window, schedule)
+
+
+def test_unchanged_run_only_lists_events(service):
+    operations = _write(_get_schedule())
+
+    assert operations == []
+    assert service.calls == ["events.list"]
+
+
+def test_changed_lesson_is_patched(service):
+    operations = _write(_get_schedule(summary="1a Ma (ændret)"))
+
+    assert [operation["id"] for operation in operations] == ["123"]
+    assert service.calls == ["events.list", "events.patch"]
@@ -0,0 +1,64 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+import pytz
+
+from lectocal import syncwindow
+
+
+def _utc(*args):
+    return pytz.utc.localize(datetime.datetime(*args))
+
+
+def test_week_53_of_2020():
+    window = syncwindow.SyncWindow(2, today=datetime.date(2020, 12, 31))
+
+    assert window.first_day == datetime.date(2020, 12, 28)
+    assert window.last_day == datetime.date(2021, 1, 17)
+    assert window.weeks == ["532020", "012021", "022021"]
+    # Copenhagen is at UTC+1 in winter
+    assert window.start == _utc(2020, 12, 27, 23, 0)
+    assert window.end == _utc(2021, 1, 17, 22, 59, 59, 999999)
+
+
+def test_week_52_to_week_1_across_new_year():
+    # The Monday of week 1 of 2026 is in 2025, but the week belongs to 2026
+    window = syncwindow.SyncWindow(2, today=datetime.date(2025, 12, 24))
+
+    assert window.first_day == datetime.date(2025, 12, 22)
+    assert window.last_day == datetime.date(2026, 1, 11)
+    assert window.weeks == ["522025", "012026", "022026"]
+    assert window.start == _utc(2025, 12, 21, 23, 0)
+    assert window.end == _utc(2026, 1, 11, 22, 59, 59, 999999)
+
+
+def test_late_december_2026():
+    # 2026 starts on a Thursday, so it has a week 53 before week 1 of 2027
+    window = syncwindow.SyncWindow(2, today=datetime.date(2026, 12, 27))
+
+    assert window.first_day == datetime.date(2026, 12, 21)
+    assert window.last_day == datetime.date(2027, 1, 10)
+    assert window.weeks == ["522026", "532026", "012027"]
+    assert window.start == _utc(2026, 12, 20, 23, 0)
+    assert window.end == _utc(2027, 1, 10, 22, 59, 59, 999999)
+
+
+def test_first_day_is_monday_of_the_current_week():
+    window = syncwindow.SyncWindow(0, today=datetime.date(2027, 1, 3))
+
+    assert window.first_day == datetime.date(2026, 12, 28)
+    assert window.last_day == datetime.date(2027, 1, 3)
+    assert window.weeks == ["532026"]